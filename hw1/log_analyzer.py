@@ -9,13 +9,15 @@ import re
 import logging
 import datetime
 import gzip
+import json
 import statistics
 from collections import namedtuple
 
 DEFAULT_CONFIG = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
-    "LOG_DIR": "./log"
+    "LOG_DIR": "./log",
+    "LOG_FORMAT": "nginx"
 }
 
 DEFAULT_CONFIG_PATH = "./log_analyzer.conf"
@@ -24,6 +26,7 @@ REPORT_TEMPLATE = "./report.html"
 REPORT_ENCODING = "utf-8"
 TS_FILE = "./log_analyzer.ts"
 LOG_NAME_PREFIX = "nginx-access-ui.log-"
+API_LOG_NAME_PREFIX = "scoring-api.log-"
 LOG_ENCODING = "utf-8"
 ERROR_THRESHOLD = 0.5
 
@@ -56,10 +59,18 @@ def check_config(config):
                     return "REPORT_SIZE should be > 0"
             except ValueError:
                 return "REPORT_SIZE should be integer"
+        elif key == "LOG_FORMAT":
+            if value not in LOG_FORMATS:
+                return "LOG_FORMAT should be one of: %s" % ", ".join(sorted(LOG_FORMATS))
+        elif key == "LOGGING":
+            # log file is created if it doesn't exist, its directory must exist
+            log_dir = os.path.dirname(value) or "."
+            if not os.path.exists(log_dir):
+                return "%s: %s - path doesn't exist-" % (key, log_dir)
         else:
             if not os.path.exists(config[key]):
                 return "%s: %s - path doesn't exist-" % (key, config[key])
-        return None
+    return None
 
 
 def get_last_log(log_dir, prefix):
@@ -132,6 +143,31 @@ def parse_log(log_path):
     return url_times, line_idx, error_count
 
 
+def parse_api_log(log_path):
+    """Return dict in the form: {"method code": [time1, time2, ...]} for scoring API log in log_path
+
+    Request records are JSON objects with "method", "code" and "elapsed" fields, written either as
+    the message of a plain log line or as a whole JSON line. Other lines (server messages, tracebacks)
+    are skipped"""
+    method_times = {}
+    line_idx = 0
+    error_count = 0
+    for line in xreadlines(log_path):
+        line_idx += 1
+        if '"elapsed"' not in line:
+            continue
+        try:
+            record = json.loads(line[line.index("{"):])
+            method_times.setdefault("%s %s" % (record["method"], record["code"]), []).append(
+                float(record["elapsed"]))
+            continue
+        except (ValueError, TypeError, KeyError):
+            pass
+        logging.error("Error in line %s: %s" % (line_idx, line.strip()))
+        error_count += 1
+    return method_times, line_idx, error_count
+
+
 def xreadlines(log_path):
     """Generator to read file one line at a time"""
     try:
@@ -176,6 +212,13 @@ def make_report(report_path, template, encoding, url_statistics):
         f.write(content)
 
 
+# log format: (log file name prefix, parser)
+LOG_FORMATS = {
+    "nginx": (LOG_NAME_PREFIX, parse_log),
+    "api": (API_LOG_NAME_PREFIX, parse_api_log)
+}
+
+
 def write_timestamp(ts_file):
     """Rewrite ts_file with line containing current timestamp"""
     with open(ts_file, 'w') as f:
@@ -186,9 +229,11 @@ def main(config):
     log_dir = config["LOG_DIR"]
     report_dir = config["REPORT_DIR"]
     report_size = int(config["REPORT_SIZE"])
+    log_format = config.get("LOG_FORMAT", "nginx")
+    log_name_prefix, parse = LOG_FORMATS[log_format]
 
     # Log file searching
-    last_log = get_last_log(log_dir, LOG_NAME_PREFIX)
+    last_log = get_last_log(log_dir, log_name_prefix)
     if not last_log.name:
         logging.info("No log files found in directory %s" % log_dir)
         sys.exit()
@@ -196,6 +241,8 @@ def main(config):
 
     # Report file searching
     report_name, report_ext = os.path.splitext(os.path.basename(REPORT_TEMPLATE))
+    if log_format != "nginx":
+        report_name += "-" + log_format
     report_path = os.path.join(report_dir,
                                report_name + "-" + last_log.date.strftime("%Y.%m.%d") + report_ext)
     if os.path.exists(report_path):
@@ -205,12 +252,12 @@ def main(config):
     # Process log
     log_path = os.path.join(log_dir, last_log.name)
     try:
-        request_times, lines, errors = parse_log(log_path)
+        request_times, lines, errors = parse(log_path)
     except OSError:
         logging.exception("Unable to open log file %s" % log_path)
         sys.exit()
     logging.info("%s lines read. %s errors found" % (lines, errors))
-    if float(errors)/lines > ERROR_THRESHOLD:
+    if lines and float(errors)/lines > ERROR_THRESHOLD:
         logging.error("Too many errors. Exiting.")
         sys.exit()
     logging.info("%s unique urls found" % len(request_times))
@@ -5,6 +5,7 @@ from log_analyzer import *
 import unittest
 from unittest.mock import patch
 import datetime
+import tempfile
 
 
 # class TestCmdLoneArgs(unittest.TestCase):
@@ -37,6 +38,15 @@ class TestInitialization(unittest.TestCase):
         self.assertEqual(check_config({"PATH": "./bad_path"}), "PATH: ./bad_path - path doesn't exist-")
         # no errors
         self.assertIsNone(check_config({"REPORT_SIZE": "10", "TEST": "./tests"}))
+        # unknown LOG_FORMAT after other valid keys
+        self.assertEqual(check_config({"REPORT_SIZE": "10", "LOG_DIR": "./tests/log", "LOG_FORMAT": "apache"}),
+                         "LOG_FORMAT should be one of: api, nginx")
+        # bad path after other valid keys
+        self.assertEqual(check_config({"REPORT_SIZE": "10", "LOG_FORMAT": "api", "REPORT_DIR": "./bad_path"}),
+                         "REPORT_DIR: ./bad_path - path doesn't exist-")
+        # log file is created, its directory must exist
+        self.assertIsNone(check_config({"LOG_FORMAT": "api", "LOGGING": "./tests/new.log"}))
+        self.assertEqual(check_config({"LOGGING": "./bad_path/new.log"}), "LOGGING: ./bad_path - path doesn't exist-")
 
 
 class TestLogsProcessing(unittest.TestCase):
@@ -75,6 +85,20 @@ class TestLogsProcessing(unittest.TestCase):
                              ['ERROR:root:Error in line 2:',
                               'ERROR:root:Error in line 3:'])
 
+    def test_parse_api_log(self):
+        # ./tests/log/api_log_example contains lines:
+        # 1 - server message, skipped
+        # 2, 3 - valid plain lines, online_score 200
+        # 4 - valid plain line, clients_interests 200
+        # 5 - valid JSON line, unknown 422
+        # 6 - invalid line - truncated record
+        with self.assertLogs() as cm:
+            method_times = parse_api_log("./tests/log/api_log_example")
+        self.assertTupleEqual(method_times,
+                              ({"online_score 200": [0.002, 0.004], "clients_interests 200": [0.01],
+                                "unknown 422": [0.001]}, 6, 1))
+        self.assertEqual(cm.output[0][:27], 'ERROR:root:Error in line 6:')
+
     def test_count_statistics(self):
         # test whether counted values and correct values are almost equal
         counted_urls = count_statistics(parse_log("./tests/log/log_example")[0])
@@ -103,11 +127,13 @@ class TestLogsProcessing(unittest.TestCase):
     def test_make_report(self):
         # test whether report file created
         test_value = datetime.datetime.now().timestamp()
-        make_report("./tests/reports/report.txt", "./tests/reports/template.txt", REPORT_ENCODING, [test_value])
-        with open("./tests/reports/report.txt") as f:
-            for line in f:
-                if line.strip().startswith("var table"):
-                    self.assertEqual(line.strip(), "var table = [%s];" % test_value)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report.txt")
+            make_report(report_path, "./tests/reports/template.txt", REPORT_ENCODING, [test_value])
+            with open(report_path) as f:
+                for line in f:
+                    if line.strip().startswith("var table"):
+                        self.assertEqual(line.strip(), "var table = [%s];" % test_value)
 
 
 if __name__ == '__main__':
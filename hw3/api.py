@@ -2,16 +2,30 @@
 # -*- coding: utf-8 -*-
 
 from abc import ABC, abstractmethod
-import json
 import datetime
+import gzip
 import logging
+import logging.handlers
 import hashlib
+import hmac
+import queue
+import random
+import time
 import uuid
 import re
+import threading
+import codec
+import metrics
 import scoring
+import store
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 
+LOG_FORMAT = "[%(asctime)s] %(levelname).1s %(message)s"
+LOG_DATE_FORMAT = "%Y.%m.%d %H:%M:%S"
+LOG_QUEUE_SIZE = 10000
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
 ADMIN_SALT = "42"
@@ -19,15 +33,32 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
+AUTH_CACHE_SIZE = 10000
+AUTH_CACHE_TTL = 24 * 60 * 60
+METHODS = ("online_score", "clients_interests", "batch")
+KEEPALIVE_TIMEOUT = 15
+GZIP_LEVEL = 5
+MAX_BODY_SIZE = 16 * 1024 * 1024
+STREAM_MIN_CLIENTS = 1000
+STREAM_CHUNK_SIZE = 500
+RATE_LIMITER_SIZE = 100000
+MAX_BATCH_SIZE = 1000
+BATCH_WORKERS = 8
 UNKNOWN = 0
 MALE = 1
 FEMALE = 2
@@ -38,9 +69,16 @@ GENDERS = {
 }
 
 
+EMPTY_VALUES = ("", (), [], {}, set())
+PHONE_PATTERN = re.compile(r"^7\d{10}$")
+NON_EMPTY_PAIRS = (("phone", "email"),
+                   ("first_name", "last_name"),
+                   ("gender", "birthday"))
+
+
 def is_empty(value):
     """Return True if value is value is set, but empty"""
-    return value in ["", (), [], {}, set()]
+    return value in EMPTY_VALUES
 
 
 class BaseField(ABC):
@@ -50,165 +88,165 @@ class BaseField(ABC):
 
 
 class Field(BaseField):
+    """Base field
+
+    Subclasses define clean(value) method: it gets a value that is not None and returns tuple
+    (error description or empty string, value converted for the next check). Field compiles clean
+    methods of all classes in its MRO into one check function, which is called by validate()"""
     def __init__(self, required=False, nullable=True):
         self.required = required
         self.nullable = nullable
+        self.check = self.compile()
+
+    def compile(self):
+        """Return function that validates value with all checks of the field in one loop"""
+        cleaners = tuple(cls.__dict__["clean"].__get__(self) for cls in reversed(type(self).__mro__)
+                         if "clean" in cls.__dict__)
+        required = self.required
+        nullable = self.nullable
+
+        def check(value):
+            if value is None:
+                return "Field is required" if required else None
+            if not nullable and value in EMPTY_VALUES:
+                return "Field can't be empty"
+            for clean in cleaners:
+                error, value = clean(value)
+                if error:
+                    return error
+            return ""
+        return check
 
     def validate(self, value):
         """Return string with error description, empty string if no errors or None if value can't be validated"""
-        if value is None:
-            if self.required:
-                return "Field is required"
-        elif is_empty(value):
-            if not self.nullable:
-                return "Field can't be empty"
-        else:
-            return ""
+        return self.check(value)
 
 
 class CharField(Field):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
+    def clean(self, value):
         if not isinstance(value, str):
-            return "Field must be a string"
-        return ""
+            return "Field must be a string", value
+        return "", value
 
 
 class ArgumentsField(Field):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
+    def clean(self, value):
         if not isinstance(value, dict):
-            return "Field must be a dict"
-        return ""
+            return "Field must be a dict", value
+        return "", value
 
 
 class EmailField(CharField):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
+    def clean(self, value):
         if "@" not in value:
-            return "Field must be a valid email"
-        return ""
+            return "Field must be a valid email", value
+        return "", value
 
 
 class PhoneField(Field):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
-        if not re.search(r"^7\d{10}$", str(value)):
-            return "Field must be a valid phone"
-        return ""
+    def clean(self, value):
+        if not PHONE_PATTERN.search(str(value)):
+            return "Field must be a valid phone", value
+        return "", value
 
 
 class DateField(CharField):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
+    def clean(self, value):
+        """Convert string to date, so subclasses check the parsed date"""
         try:
-            datetime.datetime.strptime(value, "%d.%m.%Y").date()
+            return "", datetime.datetime.strptime(value, "%d.%m.%Y").date()
         except ValueError:
-            return "Date must have format: DD.MM.YYYY"
-        return ""
+            return "Date must have format: DD.MM.YYYY", value
 
 
 class BirthDayField(DateField):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
-        birthday = datetime.datetime.strptime(value, "%d.%m.%Y").date()
+    def clean(self, birthday):
         today = datetime.date.today()
         age = today.year - birthday.year
         if (today.month, today.day) < (birthday.month, birthday.day):
             age -= 1
         if age > 70:
-            return "Birthday must be not more than 70 years from now"
-        return ""
+            return "Birthday must be not more than 70 years from now", birthday
+        return "", birthday
 
 
 class GenderField(Field):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
-        if value not in GENDERS:
-            return "Gender must be a number %s, %s, %s" % (UNKNOWN, MALE, FEMALE)
-        return ""
+    def clean(self, value):
+        try:
+            valid = value in GENDERS
+        except TypeError:  # unhashable value: list or dict
+            valid = False
+        if not valid:
+            return "Gender must be a number %s, %s, %s" % (UNKNOWN, MALE, FEMALE), value
+        return "", value
 
 
 class ClientIDsField(Field):
-    def validate(self, value):
-        error = super().validate(value)
-        if error:
-            return error
-        # can't validate None
-        if value is None:
-            return None
+    def clean(self, value):
         if not isinstance(value, list):
-            return "Field must be a list of integer"
+            return "Field must be a list of integer", value
         for client_id in value:
             if not isinstance(client_id, int):
-                return "Field must be a list of integer"
-        return ""
+                return "Field must be a list of integer", value
+        return "", value
+
+
+def compile_validator(schema):
+    """Return function that validates request object against schema in one loop"""
+    checks = tuple((name, field.check) for name, field in schema.items())
+
+    def validator(request):
+        errors = {}
+        for name, check in checks:
+            error = check(getattr(request, name))
+            if error:
+                errors[name] = error
+        return errors
+    return validator
 
 
 class MetaRequest(type):
-    """Metaclass. Gather all Field attributes declared in class definition into new "schema" attribute"""
+    """Metaclass. Gather all Field attributes declared in class definition into new "schema" attribute
+
+    The schema is compiled into "validator" function, field values are stored in __slots__"""
     def __new__(mcs, name, bases, attrs):
         schema = {}
         for attr, value in attrs.items():
             if isinstance(value, Field):
                 schema[attr] = value
         attrs["schema"] = schema
+        attrs["validator"] = staticmethod(compile_validator(schema))
+        attrs["__slots__"] = tuple(attrs.get("__slots__", ())) + tuple(schema)
         for attr in schema:
             del attrs[attr]
         return super(MetaRequest, mcs).__new__(mcs, name, bases, attrs)
 
 
 class Request(metaclass=MetaRequest):
+    __slots__ = ("request",)
+
     def __init__(self, request):
         self.request = request
         for name in self.schema:
-            value = self.request.get(name, None)
-            setattr(self, name, value)
+            setattr(self, name, request.get(name))
 
     def validate(self):
         """Return dict with erroneous fields and their description or empty dict if no errors"""
-        errors = {}
-        for name, field in self.schema.items():
-            value = getattr(self, name)
-            field_error = field.validate(value)
-            if field_error:
-                errors[name] = field_error
-        return errors
+        return self.validator(self)
+
+
+class StreamingResponse:
+    """Response dict which is built and sent to client by parts
+
+    parts is an iterable of dicts, the response is their union"""
+    def __init__(self, parts):
+        self.parts = parts
+
+    def to_dict(self):
+        response = {}
+        for part in self.parts:
+            response.update(part)
+        return response
 
 
 class ClientsInterestsRequest(Request):
@@ -216,14 +254,26 @@ class ClientsInterestsRequest(Request):
     date = DateField(required=False, nullable=True)
 
     def handle(self, ctx, store):
-        errors = self.validate()
+        with metrics.STAGE_LATENCY.time("clients_interests", "validation"):
+            errors = self.validate()
         if errors:
             return errors, INVALID_REQUEST
 
         ctx.update({"nclients": len(self.client_ids)})
 
-        interests = {str(cid): scoring.get_interests(store, cid) for cid in self.client_ids}
-        return interests, OK
+        if len(self.client_ids) >= STREAM_MIN_CLIENTS:
+            return StreamingResponse(self.iter_interests(store)), OK
+        with metrics.STAGE_LATENCY.time("clients_interests", "scoring"):
+            interests = scoring.get_interests_many(store, self.client_ids)
+        return {str(cid): value for cid, value in interests.items()}, OK
+
+    def iter_interests(self, store):
+        """Yield interests of unique clients by STREAM_CHUNK_SIZE clients"""
+        client_ids = list(dict.fromkeys(self.client_ids))
+        for i in range(0, len(client_ids), STREAM_CHUNK_SIZE):
+            with metrics.STAGE_LATENCY.time("clients_interests", "scoring"):
+                interests = scoring.get_interests_many(store, client_ids[i:i + STREAM_CHUNK_SIZE])
+            yield {str(cid): value for cid, value in interests.items()}
 
 
 class OnlineScoreRequest(Request):
@@ -236,15 +286,8 @@ class OnlineScoreRequest(Request):
 
     def validate(self):
         errors = super().validate()
-        non_empty_pairs = [["phone", "email"],
-                           ["first_name", "last_name"],
-                           ["gender", "birthday"]]
-        all_pairs_empty = True
-        for pair in non_empty_pairs:
-            if pair[0] in self.non_empty_field() and pair[1] in self.non_empty_field():
-                all_pairs_empty = False
-                break
-        if all_pairs_empty:
+        non_empty = self.non_empty_field()
+        if not any(first in non_empty and second in non_empty for first, second in NON_EMPTY_PAIRS):
             errors["online_score"] = " At least one pair phone‑email, first name‑last name, gender‑birthday" + \
                                      " must not be empty"
         return errors
@@ -253,24 +296,26 @@ class OnlineScoreRequest(Request):
         not_empty = []
         for field in self.schema:
             value = getattr(self, field)
-            if value is not None and not is_empty(value):
+            if value is not None and value not in EMPTY_VALUES:
                 not_empty.append(field)
         return not_empty
 
     def handle(self, ctx, store, is_admin):
-        errors = self.validate()
+        with metrics.STAGE_LATENCY.time("online_score", "validation"):
+            errors = self.validate()
         if errors:
             return errors, INVALID_REQUEST
         ctx.update({"has": self.non_empty_field()})
         if is_admin:
             return {"score": 42}, OK
-        score = scoring.get_score(store,
-                                  phone=self.phone,
-                                  email=self.email,
-                                  birthday=self.birthday,
-                                  gender=self.gender,
-                                  first_name=self.first_name,
-                                  last_name=self.last_name)
+        with metrics.STAGE_LATENCY.time("online_score", "scoring"):
+            score = scoring.get_score(store,
+                                      phone=self.phone,
+                                      email=self.email,
+                                      birthday=self.birthday,
+                                      gender=self.gender,
+                                      first_name=self.first_name,
+                                      last_name=self.last_name)
         return {"score": score}, OK
 
 
@@ -286,27 +331,92 @@ class MethodRequest(Request):
         return self.login == ADMIN_LOGIN
 
 
+# verified (account, login, token) triples. Admin tokens expire at the end of the hour
+verified_tokens = store.LRUCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
 def check_auth(request):
+    key = (request.account, request.login, request.token)
+    if verified_tokens.get(key):
+        return True
     if request.is_admin:
-        msg = (datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).encode()
+        now = datetime.datetime.now()
+        msg = (now.strftime("%Y%m%d%H") + ADMIN_SALT).encode()
+        lifetime = 60 * 60 - (now.minute * 60 + now.second + now.microsecond / 1e6)
     else:
         if request.account is None:
             account = ""  # TODO: is it secure?
         else:
             account = request.account
         msg = (account + request.login + SALT).encode()
+        lifetime = None
     digest = hashlib.sha512(msg).hexdigest()
-    if digest == request.token:
+    if hmac.compare_digest(digest.encode(), (request.token or "").encode()):
+        verified_tokens.set(key, True, lifetime)
         return True
     return False
 
 
-def method_handler(request, ctx, store):
+def method_label(method):
+    """Return method name for metrics. Unknown names are replaced to keep the number of labels bounded"""
+    return method if method in METHODS else "unknown"
+
+
+def accepts_gzip(accept_encoding):
+    """Return True if Accept-Encoding header value allows gzip"""
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            return q > 0
+    return False
+
+
+def make_response(response, code):
+    """Return response object sent to client"""
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+# serialized responses for errors without a description
+ERROR_RESPONSES = {code: codec.dumps(make_response(None, code)) for code in ERRORS}
+
+
+def method_handler(request, ctx, store, auth_cache=None):
+    """Handle method request or a batch (list) of method requests
+
+    auth_cache is a dict to reuse check_auth results, keyed by (account, login, token)"""
+    if isinstance(request["body"], list):
+        ctx.update({"method": "batch"})
+        return batch_handler(request, ctx, store)
+    if not isinstance(request["body"], dict):
+        return ERRORS[BAD_REQUEST], BAD_REQUEST
+    started = time.perf_counter()
     method_request = MethodRequest(request["body"])
     errors = method_request.validate()
+    method = method_label(method_request.method)
+    metrics.STAGE_LATENCY.observe(time.perf_counter() - started, method, "validation")
     if errors:
         return errors, INVALID_REQUEST
-    if not check_auth(method_request):
+    ctx.update({"method": method_request.method})
+    started = time.perf_counter()
+    if auth_cache is None:
+        authorized = check_auth(method_request)
+    else:
+        auth_key = (method_request.account, method_request.login, method_request.token)
+        if auth_key not in auth_cache:
+            auth_cache[auth_key] = check_auth(method_request)
+        authorized = auth_cache[auth_key]
+    metrics.STAGE_LATENCY.observe(time.perf_counter() - started, method, "auth")
+    if not authorized:
         return ERRORS[FORBIDDEN], FORBIDDEN
     if method_request.method == "online_score":
         return OnlineScoreRequest(method_request.arguments).handle(ctx, store, method_request.is_admin)
@@ -316,28 +426,282 @@ def method_handler(request, ctx, store):
         return ERRORS[NOT_FOUND], NOT_FOUND
 
 
+batch_executor = ThreadPoolExecutor(BATCH_WORKERS)
+
+
+def batch_handler(request, ctx, store):
+    """Handle list of method requests concurrently
+
+    Return list of responses in the form {"code": <code>, "response"|"error": <...>} in input order.
+    Authentication results are shared between requests of the batch"""
+    body = request["body"]
+    if len(body) > MAX_BATCH_SIZE:
+        return "Batch must contain not more than %s requests" % MAX_BATCH_SIZE, INVALID_REQUEST
+    auth_cache = {}
+    contexts = [{} for _ in body]
+
+    def handle(i):
+        if isinstance(body[i], list):
+            return make_response(None, BAD_REQUEST)
+        try:
+            response, code = method_handler({"body": body[i], "headers": request["headers"]},
+                                            contexts[i], store, auth_cache)
+            if isinstance(response, StreamingResponse):
+                response = response.to_dict()
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            response, code = None, INTERNAL_ERROR
+        return make_response(response, code)
+
+    if len(body) > 1:
+        responses = list(batch_executor.map(handle, range(len(body))))
+    else:
+        responses = [handle(i) for i in range(len(body))]
+    ctx.update({"batch": contexts})
+    return responses, OK
+
+
+class RateLimiter:
+    """Token bucket rate limiter per key: rate tokens are added per second, up to burst tokens
+
+    Buckets of at most maxsize recently used keys are kept"""
+    def __init__(self, rate, burst, maxsize=RATE_LIMITER_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, tokens=1):
+        """Take tokens from the bucket of key, return False if there are not enough tokens"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                available = self.burst
+            else:
+                available = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self._buckets.move_to_end(key)
+            allowed = available >= tokens
+            self._buckets[key] = (available - tokens if allowed else available, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+def rate_limit_keys(body, client_address):
+    """Return dict {rate limiter key: number of method requests} for method request or batch
+
+    Requests with a valid token are counted against their login, the others against client_address,
+    so requests with forged tokens can't exhaust the limit of another login"""
+    keys = {}
+    for item in body if isinstance(body, list) else [body]:
+        key = "address:%s" % client_address
+        if isinstance(item, dict):
+            request = MethodRequest(item)
+            if (isinstance(request.login, str) and isinstance(request.token, str)
+                    and isinstance(request.account, (str, type(None))) and check_auth(request)):
+                key = "login:%s" % request.login
+        keys[key] = keys.get(key, 0) + 1
+    return keys
+
+
+def metrics_handler(request, ctx, store):
+    """Return metrics in Prometheus text format"""
+    if store is not None:
+        stats = store.cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        metrics.CACHE_REQUESTS.set(stats["hits"], "hit")
+        metrics.CACHE_REQUESTS.set(stats["misses"], "miss")
+        metrics.CACHE_HIT_RATIO.set(stats["hits"] / lookups if lookups else 0.0)
+    return metrics.render(), OK
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log record as a JSON line. Request context (record.context) is written as record fields"""
+    def format(self, record):
+        entry = {"time": self.formatTime(record, LOG_DATE_FORMAT), "level": record.levelname}
+        context = getattr(record, "context", None)
+        if context is not None:
+            entry.update(context)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return codec.dumps(entry).decode()
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Put records into a bounded queue without blocking
+
+    If the queue is full, successful request records are dropped. Errors, warnings and failed requests
+    wait for a free slot, so they are always logged"""
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # request records are formatted by the writer thread
+        if getattr(record, "context", None) is not None:
+            return record
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.droppable(record):
+                self.dropped += 1
+            else:
+                self.queue.put(record)
+
+    @staticmethod
+    def droppable(record):
+        context = getattr(record, "context", None)
+        return record.levelno < logging.WARNING and context is not None and context.get("code") == OK
+
+
+def setup_logging(filename=None, use_queue=False):
+    """Configure root logger
+
+    With use_queue records are put into a queue and written as JSON lines by a background thread.
+    Return started QueueListener (should be stopped on exit) or None"""
+    if not use_queue:
+        logging.basicConfig(filename=filename, level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+        return None
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    logger = logging.getLogger()
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+
+class JsonMessage:
+    """Log message serialized to JSON when the record is formatted"""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return codec.dumps(self.obj).decode()
+
+
+def log_request(context, code, sample_rate=1.0):
+    """Log request context as a JSON object. Successful requests are logged with probability sample_rate,
+    errors always"""
+    if code == OK and sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    logging.info(JsonMessage(context), extra={"context": context})
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
+    get_router = {
+        "metrics": metrics_handler
+    }
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes: with Nagle's algorithm the body of a kept-alive connection
+    # waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+    # idle keep-alive connections are closed after timeout seconds
+    timeout = KEEPALIVE_TIMEOUT
     store = None
+    log_sample_rate = 1.0
+    max_body_size = MAX_BODY_SIZE
+    # minimal size of response body to compress, None - responses are not compressed
+    gzip_min_size = None
+    # semaphore limiting requests in flight and RateLimiter of requests per login, None - no limits
+    admission = None
+    rate_limiter = None
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+    def log_request(self, code="-", size="-"):
+        # access log lines duplicate the request log records
+        logging.debug('%s - "%s" %s %s', self.address_string(), self.requestline, int(code) if code != "-" else code,
+                      size)
+
+    def log_error(self, format, *args):
+        logging.warning("%s - %s", self.address_string(), format % args)
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
     def do_POST(self):
-        response, code = {}, OK
+        if self.admission is not None and not self.admission.acquire(blocking=False):
+            # overloaded: reject without reading the body
+            self.close_connection = True
+            self.send_body(SERVICE_UNAVAILABLE, ERROR_RESPONSES[SERVICE_UNAVAILABLE], "application/json")
+            metrics.REQUESTS.inc(method_label(None), SERVICE_UNAVAILABLE)
+            return
+        try:
+            self.handle_method_request()
+        finally:
+            if self.admission is not None:
+                self.admission.release()
+
+    def handle_method_request(self):
+        metrics.IN_FLIGHT.inc()
+        started = time.perf_counter()
         context = {"request_id": self.get_request_id(self.headers)}
+        try:
+            response, code = self.handle_post(context)
+            self.send_result(response, code, context)
+        finally:
+            metrics.IN_FLIGHT.dec()
+        elapsed = time.perf_counter() - started
+        method = method_label(context.get("method"))
+        metrics.REQUESTS.inc(method, code)
+        metrics.REQUEST_LATENCY.observe(elapsed, method)
+        context.update({"method": method, "elapsed": round(elapsed, 6)})
+        log_request(context, code, self.log_sample_rate)
+
+    def do_GET(self):
+        path = self.path.strip("/")
+        if path not in self.get_router:
+            self.send_result(None, NOT_FOUND, {})
+            return
+        text, code = self.get_router[path]({"headers": self.headers}, {}, self.store)
+        self.send_body(code, text.encode(), "text/plain; version=0.0.4")
+
+    def handle_post(self, context):
+        """Read request and pass it to the router, return (response, code)"""
+        response, code = {}, OK
         request = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.close_connection = True
+            return response, BAD_REQUEST
+        if length < 0:
+            # read(-1) would wait for the client to close the connection
+            self.close_connection = True
+            return response, BAD_REQUEST
+        if length > self.max_body_size:
+            # the body is not read, so the connection can't be reused
+            self.close_connection = True
+            return response, REQUEST_ENTITY_TOO_LARGE
+        try:
+            data_string = self.rfile.read(length)
+            request = codec.loads(data_string)
         except:
             code = BAD_REQUEST
 
+        if request and self.rate_limiter is not None:
+            for key, count in rate_limit_keys(request, self.client_address[0]).items():
+                if not self.rate_limiter.allow(key, count):
+                    return response, TOO_MANY_REQUESTS
         if request:
             path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            logging.debug("%s: %s %s", self.path, data_string, context["request_id"])
             if path in self.router:
                 try:
                     response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
@@ -346,30 +710,122 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
+        return response, code
+
+    def send_result(self, response, code, context):
+        if isinstance(response, StreamingResponse):
+            self.send_stream(response, code, context)
+            return
+        r = make_response(response, code)
+        context.update(r)
+        if code in ERROR_RESPONSES and (not response or response == ERRORS[code]):
+            body = ERROR_RESPONSES[code]
+        else:
+            body = codec.dumps(r)
+        self.send_body(code, body, "application/json")
 
+    def send_body(self, code, body, content_type):
+        """Send response with Content-Length, gzip-compressed if it is enabled and accepted by client"""
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        if self.gzip_min_size is not None and len(body) >= self.gzip_min_size:
+            self.send_header("Vary", "Accept-Encoding")
+            if accepts_gzip(self.headers.get("Accept-Encoding")):
+                body = gzip.compress(body, GZIP_LEVEL)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        self.wfile.write(body)
+
+    def send_stream(self, response, code, context):
+        """Send response by parts with chunked transfer encoding (close-delimited for HTTP/1.0)"""
+        chunked = self.protocol_version == "HTTP/1.1" and self.request_version != "HTTP/1.0"
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode())
-        return
+            self.send_header("Connection", "close")
+        self.end_headers()
+        context.update({"code": code, "streamed": True})
+
+        def write(data):
+            if chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        write(b'{"response":{')
+        separator = b""
+        try:
+            for part in response.parts:
+                if part:
+                    # serialized part without enclosing braces
+                    write(separator + codec.dumps(part)[1:-1])
+                    separator = b","
+        except Exception as e:
+            # headers are already sent: break the response, so the client gets an incomplete body
+            logging.exception("Unexpected error: %s" % e)
+            context.update({"code": INTERNAL_ERROR})
+            self.close_connection = True
+            return
+        write(b'},"code":%d}' % code)
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+
+def make_server(host, port, threaded=True):
+    """Return HTTP server with MainHTTPHandler
+
+    Connections are kept alive by the threaded server only: the single-threaded server speaks HTTP/1.0,
+    otherwise one idle keep-alive client would block all the others"""
+    if threaded:
+        return ThreadingHTTPServer((host, port), MainHTTPHandler)
+    handler_class = type("MainHTTPHandler", (MainHTTPHandler,), {"protocol_version": "HTTP/1.0"})
+    return HTTPServer((host, port), handler_class)
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-t", "--threaded", action="store_true", default=False)
+    op.add_option("--max-body-size", action="store", type=int, default=MAX_BODY_SIZE)
+    op.add_option("--keepalive-timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT)
+    op.add_option("--gzip-min-size", action="store", type=int, default=None)
+    op.add_option("--max-in-flight", action="store", type=int, default=None)
+    op.add_option("--rate-limit", action="store", type=float, default=None)
+    op.add_option("--rate-burst", action="store", type=float, default=None)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-queue", action="store_true", default=False)
+    op.add_option("--log-sample", action="store", type=float, default=1.0)
+    op.add_option("-s", "--store", action="store", default="redis", choices=store.BACKENDS)
+    op.add_option("--sqlite-path", action="store", default=store.SQLITE_PATH)
+    op.add_option("--db-host", action="store", default=store.DB_HOST)
+    op.add_option("--db-port", action="store", type=int, default=store.DB_PORT)
+    op.add_option("--db-timeout", action="store", type=float, default=store.DB_TIMEOUT)
+    op.add_option("--db-pool-size", action="store", type=int, default=store.DB_MAX_CONNECTIONS)
+    op.add_option("--db-retries", action="store", type=int, default=store.DB_RETRIES)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    log_listener = setup_logging(opts.log, opts.log_queue)
+    MainHTTPHandler.log_sample_rate = opts.log_sample
+    MainHTTPHandler.max_body_size = opts.max_body_size
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.gzip_min_size = opts.gzip_min_size
+    if opts.max_in_flight and not opts.threaded:
+        op.error("--max-in-flight requires --threaded")
+    if opts.max_in_flight:
+        MainHTTPHandler.admission = threading.BoundedSemaphore(opts.max_in_flight)
+    if opts.rate_limit:
+        MainHTTPHandler.rate_limiter = RateLimiter(opts.rate_limit, opts.rate_burst or opts.rate_limit)
+    MainHTTPHandler.store = store.create(opts.store, sqlite_path=opts.sqlite_path, host=opts.db_host,
+                                         port=opts.db_port, timeout=opts.db_timeout,
+                                         max_connections=opts.db_pool_size, retries=opts.db_retries)
+    server = make_server("localhost", opts.port, opts.threaded)
     logging.info("Starting server at %s" % opts.port)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+    if log_listener:
+        log_listener.stop()
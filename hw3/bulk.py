@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline bulk scoring
+
+Reads JSONL file with arguments of online_score or clients_interests method (one JSON object per line),
+validates and scores the records in a process pool and writes JSONL file with responses
+{"code": <code>, "response"|"error": ...} in the same order as input records"""
+
+import logging
+import multiprocessing
+import sys
+from optparse import OptionParser
+
+import api
+import codec
+import scoring
+import store
+
+BATCH_SIZE = 1000
+WORKERS = multiprocessing.cpu_count()
+
+worker_store = None
+
+
+def init_worker(backend, store_params):
+    """Create store of the worker process"""
+    global worker_store
+    worker_store = store.create(backend, **store_params) if backend != "none" else None
+
+
+def parse_records(lines, request_class):
+    """Return list of (request or None, response for invalid record or None)"""
+    records = []
+    for line in lines:
+        try:
+            arguments = codec.loads(line)
+        except ValueError:
+            records.append((None, api.make_response(None, api.BAD_REQUEST)))
+            continue
+        if not isinstance(arguments, dict):
+            records.append((None, api.make_response(None, api.BAD_REQUEST)))
+            continue
+        try:
+            request = request_class(arguments)
+            errors = request.validate()
+        except Exception as e:
+            logging.exception("Unable to validate record: %s" % e)
+            records.append((None, api.make_response(None, api.INVALID_REQUEST)))
+            continue
+        if errors:
+            records.append((None, api.make_response(errors, api.INVALID_REQUEST)))
+        else:
+            records.append((request, None))
+    return records
+
+
+def fetch_scores(db, keys):
+    """Return dict {key: stored score or None} for keys, fetched with one mget per chunk"""
+    if db is None:
+        return {}
+    try:
+        return db.get_many(keys)
+    except Exception as e:
+        logging.exception("Store get_many failed: %s" % e)
+        return {}
+
+
+def save_scores(db, scores):
+    """Write dict {key: score} to db with one mset per chunk"""
+    if db is None or not scores:
+        return
+    try:
+        db.set_many(scores, scoring.SCORE_LIFETIME)
+    except Exception as e:
+        logging.exception("Store set_many failed: %s" % e)
+
+
+def score_batch(lines, db=None):
+    """Return list of responses for lines with online_score arguments
+
+    Stored scores of the batch are read with get_many; missing scores are computed locally
+    and written back with set_many"""
+    db = db if db is not None else worker_store
+    records = parse_records(lines, api.OnlineScoreRequest)
+    keys = [scoring.score_key(request.phone, request.email, request.birthday, request.gender,
+                              request.first_name, request.last_name) if request is not None else None
+            for request, _ in records]
+    stored = fetch_scores(db, [key for key in keys if key is not None])
+    computed = {}
+    responses = []
+    for key, (request, response) in zip(keys, records):
+        if request is not None:
+            score = stored.get(key)
+            if score is not None:
+                score = float(score)
+            elif key in computed:
+                score = computed[key]
+            else:
+                score = computed[key] = scoring.calculate_score(request.phone, request.email, request.birthday,
+                                                                request.gender, request.first_name,
+                                                                request.last_name)
+            response = api.make_response({"score": score}, api.OK)
+        responses.append(response)
+    save_scores(db, computed)
+    return responses
+
+
+def interests_batch(lines, db=None):
+    """Return list of responses for lines with clients_interests arguments"""
+    db = db if db is not None else worker_store
+    records = parse_records(lines, api.ClientsInterestsRequest)
+    client_ids = [cid for request, _ in records if request is not None for cid in request.client_ids]
+    try:
+        interests = scoring.get_interests_many(db, client_ids)
+    except Exception as e:
+        logging.exception("Unable to get interests: %s" % e)
+        interests = None
+    responses = []
+    for request, response in records:
+        if request is not None:
+            if interests is None:
+                response = api.make_response(None, api.INTERNAL_ERROR)
+            else:
+                response = api.make_response({str(cid): interests[cid] for cid in request.client_ids}, api.OK)
+        responses.append(response)
+    return responses
+
+
+HANDLERS = {
+    "online_score": score_batch,
+    "clients_interests": interests_batch,
+}
+
+
+def process_batch(args):
+    method, lines = args
+    return b"".join(codec.dumps(response) + b"\n" for response in HANDLERS[method](lines))
+
+
+def read_batches(lines, method, batch_size):
+    """Yield (method, list of lines) by batch_size lines"""
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield method, batch
+            batch = []
+    if batch:
+        yield method, batch
+
+
+def main(method, input_file, output_file, workers, batch_size, backend, store_params):
+    batches = read_batches(input_file, method, batch_size)
+    if workers <= 1:
+        init_worker(backend, store_params)
+        results = map(process_batch, batches)
+        for result in results:
+            output_file.write(result)
+        return
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(backend, store_params)) as pool:
+        for result in pool.imap(process_batch, batches):
+            output_file.write(result)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [INPUT [OUTPUT]]")
+    op.add_option("-m", "--method", action="store", default="online_score", choices=list(HANDLERS))
+    op.add_option("-w", "--workers", action="store", type=int, default=WORKERS)
+    op.add_option("-b", "--batch-size", action="store", type=int, default=BATCH_SIZE)
+    op.add_option("-s", "--store", action="store", default="redis", choices=store.BACKENDS + ("none",))
+    op.add_option("--sqlite-path", action="store", default=store.SQLITE_PATH)
+    op.add_option("--db-host", action="store", default=store.DB_HOST)
+    op.add_option("--db-port", action="store", type=int, default=store.DB_PORT)
+    op.add_option("--db-timeout", action="store", type=float, default=store.DB_TIMEOUT)
+    op.add_option("--db-retries", action="store", type=int, default=store.DB_RETRIES)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format=api.LOG_FORMAT, datefmt=api.LOG_DATE_FORMAT)
+    if opts.store == "sqlite":
+        store_params = {"sqlite_path": opts.sqlite_path}
+    else:
+        store_params = {"host": opts.db_host, "port": opts.db_port, "timeout": opts.db_timeout,
+                        "retries": opts.db_retries}
+    input_file = open(args[0], "rb") if len(args) > 0 else sys.stdin.buffer
+    output_file = open(args[1], "wb") if len(args) > 1 else sys.stdout.buffer
+    try:
+        main(opts.method, input_file, output_file, opts.workers, opts.batch_size, opts.store, store_params)
+    finally:
+        input_file.close()
+        output_file.close()
@@ -0,0 +1,31 @@
+"""JSON codec. Uses orjson or ujson if installed and json from the standard library otherwise"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+encoder = json.JSONEncoder()
+
+
+def loads(data):
+    """Return object deserialized from JSON str or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Return obj serialized to JSON as bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    if ujson is not None:
+        return ujson.dumps(obj).encode()
+    return encoder.encode(obj).encode()
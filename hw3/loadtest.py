@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load generator for the Scoring API
+
+Starts the API server in a separate process with a local store (no Redis required), sends signed
+online_score or clients_interests requests with several concurrent clients and reports RPS and latency"""
+
+import datetime
+import hashlib
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+import api
+import scoring
+import store
+
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+
+
+def make_token(account, login):
+    """Return token accepted by api.check_auth"""
+    if login == api.ADMIN_LOGIN:
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+    else:
+        msg = (account or "") + login + api.SALT
+    return hashlib.sha512(msg.encode()).hexdigest()
+
+
+def make_arguments(method, rnd, users, clients):
+    if method == "online_score":
+        user = rnd.randrange(users)
+        return {"phone": "7%010d" % user,
+                "email": "user%s@otus.ru" % user,
+                "first_name": "First%s" % user,
+                "last_name": "Last%s" % user,
+                "birthday": "01.01.1990",
+                "gender": user % 3}
+    return {"client_ids": [rnd.randrange(users) for _ in range(clients)], "date": "20.07.2017"}
+
+
+def make_request(method, rnd, users, clients, login=LOGIN):
+    return {"account": ACCOUNT,
+            "login": login,
+            "method": method,
+            "token": make_token(ACCOUNT, login),
+            "arguments": make_arguments(method, rnd, users, clients)}
+
+
+def make_bodies(method, count, users, clients, batch, seed=0):
+    """Return list of serialized request bodies. method is online_score, clients_interests or mixed"""
+    rnd = random.Random(seed)
+    methods = ["online_score", "clients_interests"] if method == "mixed" else [method]
+    bodies = []
+    for _ in range(count):
+        requests = [make_request(rnd.choice(methods), rnd, users, clients) for _ in range(batch)]
+        bodies.append(json.dumps(requests if batch > 1 else requests[0]).encode())
+    return bodies
+
+
+def make_store(users, backend="memory", sqlite_path=None):
+    """Return store of the backend (memory or sqlite) with interests of users clients"""
+    if backend == "sqlite":
+        db = store.SQLiteStore(sqlite_path)
+    else:
+        db = store.MemoryStore()
+    rnd = random.Random(0)
+    for cid in range(users):
+        db.set(scoring.interests_key(cid), json.dumps(rnd.sample(INTERESTS, 2)))
+    return db
+
+
+def serve(users, backend, sqlite_path, port_queue):
+    """Run API server on a free port with local store, put the port into port_queue"""
+    api.MainHTTPHandler.store = make_store(users, backend, sqlite_path)
+    server = api.make_server("localhost", 0)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(users, backend="memory", sqlite_path=None):
+    """Start API server process, return (process, port)"""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(users, backend, sqlite_path, port_queue), daemon=True)
+    process.start()
+    return process, port_queue.get(timeout=10)
+
+
+def run(host, port, bodies, concurrency):
+    """Send bodies to the server with concurrency clients, return (latencies, errors, elapsed time)"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    position = iter(range(len(bodies)))
+
+    def client():
+        connection = http.client.HTTPConnection(host, port)
+        local_latencies = []
+        local_errors = 0
+        while True:
+            with lock:
+                i = next(position, None)
+            if i is None:
+                break
+            started = time.perf_counter()
+            try:
+                connection.request("POST", "/method/", bodies[i], {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                data = response.read()
+                if response.status != api.OK or json.loads(data)["code"] != api.OK:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+            local_latencies.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(errors), time.perf_counter() - started
+
+
+def percentile(values, p):
+    """Return p-th percentile of sorted values (nearest rank)"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+
+def report(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {"requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3)}
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-m", "--method", action="store", default="online_score",
+                  choices=["online_score", "clients_interests", "mixed"])
+    op.add_option("-n", "--requests", action="store", type=int, default=10000)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=10)
+    op.add_option("--users", action="store", type=int, default=1000, help="number of distinct users/clients")
+    op.add_option("--clients", action="store", type=int, default=10, help="client ids per clients_interests request")
+    op.add_option("--batch", action="store", type=int, default=1, help="method requests per POST")
+    op.add_option("-s", "--store", action="store", default="memory", choices=["memory", "sqlite"])
+    op.add_option("--sqlite-path", action="store", default=None, help="default is a temporary file")
+    op.add_option("--host", action="store", default=None, help="use running server instead of starting one")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    (opts, args) = op.parse_args()
+    bodies = make_bodies(opts.method, opts.requests, opts.users, opts.clients, opts.batch)
+    if opts.host is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sqlite_path = opts.sqlite_path or os.path.join(tmp_dir, "store.db")
+            process, port = start_server(opts.users, opts.store, sqlite_path)
+            print(json.dumps(report(*run("localhost", port, bodies, opts.concurrency))))
+            process.terminate()
+    else:
+        print(json.dumps(report(*run(opts.host, opts.port, bodies, opts.concurrency))))
@@ -0,0 +1,132 @@
+"""Request metrics in Prometheus text format
+
+Metrics are process-wide. Every update takes a short per-metric lock, cheap enough for each request"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+registry = []
+
+
+def format_labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """Return list of (name suffix, labels string, value)"""
+        with self._lock:
+            values = list(self._values.items())
+        return [("", format_labels(self.labels, labels), value) for labels, value in sorted(values)]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, labels, format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # bucket counts, +Inf bucket, sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe duration of the with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def get(self, *labels):
+        return self._values.get(labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        samples = []
+        for labels, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % (bound if bound == "+Inf" else format_value(float(bound)))
+                samples.append(("_bucket", format_labels(self.labels, labels, le), cumulative))
+            samples.append(("_sum", format_labels(self.labels, labels), counts[-1]))
+            samples.append(("_count", format_labels(self.labels, labels), cumulative))
+        return samples
+
+
+def render():
+    """Return all metrics in Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+REQUESTS = Counter("api_requests_total", "Number of requests by API method and response code", ("method", "code"))
+REQUEST_LATENCY = Histogram("api_request_duration_seconds", "Request handling time by API method", ("method",))
+STAGE_LATENCY = Histogram("api_stage_duration_seconds",
+                          "Time of request handling stages: validation, auth, scoring", ("method", "stage"))
+IN_FLIGHT = Gauge("api_requests_in_flight", "Number of requests being handled")
+STORE_LATENCY = Histogram("store_command_duration_seconds", "Store command time", ("command",))
+CACHE_REQUESTS = Gauge("store_cache_requests", "Store in-process cache lookups by result", ("result",))
+CACHE_HIT_RATIO = Gauge("store_cache_hit_ratio", "Share of store in-process cache lookups that were hits")
@@ -1,7 +1,135 @@
+import json
 import random
+import hashlib
+import logging
+import threading
+
+SCORE_LIFETIME = 60 * 60
+
+
+class Call:
+    """Call in flight. Followers wait for the event and share result or error of the call"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key: one thread makes the call, the others wait for its result"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _join(self, keys):
+        """Return dicts of calls started by this thread and calls in flight (followed) for keys"""
+        started, followed = {}, {}
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is None:
+                    started[key] = self._calls[key] = Call()
+                else:
+                    call.waiters += 1
+                    followed[key] = call
+        return started, followed
+
+    def _finish(self, calls, results=None, error=None):
+        with self._lock:
+            for key in calls:
+                del self._calls[key]
+        for key, call in calls.items():
+            call.error = error
+            if results is not None:
+                call.result = results.get(key)
+            call.event.set()
+
+    def do(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs) or the result of the call with the same key in flight"""
+        started, followed = self._join([key])
+        if followed:
+            return followed[key].wait()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(started, error=e)
+            raise
+        self._finish(started, {key: result})
+        return result
+
+    def do_many(self, keys, func):
+        """Return dict {key: value} for keys
+
+        func(keys) returns such dict. It is called once for keys that are not in flight,
+        results of the other keys are taken from the calls in flight"""
+        started, followed = self._join(dict.fromkeys(keys))
+        results = {}
+        if started:
+            try:
+                results = func(list(started))
+            except BaseException as e:
+                self._finish(started, error=e)
+                raise
+            self._finish(started, results)
+        for key, call in followed.items():
+            results[key] = call.wait()
+        return results
+
+
+flights = SingleFlight()
+
+
+def score_key(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    """Return store key for the score of user with given attributes"""
+    key_parts = [str(part) if part is not None else "" for part in
+                 [phone, email, birthday, gender, first_name, last_name]]
+    return "uid:" + hashlib.md5("\0".join(key_parts).encode()).hexdigest()
+
+
+def cache_get(store, key):
+    """Return value cached in store or None. Store errors are logged and treated as a cache miss"""
+    if store is None:
+        return None
+    try:
+        return store.cache_get(key)
+    except Exception as e:
+        logging.exception("Store cache_get failed: %s" % e)
+        return None
+
+
+def cache_set(store, key, value, lifetime):
+    """Cache value in store. Store errors are logged and ignored"""
+    if store is None:
+        return
+    try:
+        store.cache_set(key, value, lifetime)
+    except Exception as e:
+        logging.exception("Store cache_set failed: %s" % e)
 
 
 def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(phone, email, birthday, gender, first_name, last_name)
+    return flights.do(key, compute_score, store, key, phone, email, birthday, gender, first_name, last_name)
+
+
+def compute_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    score = cache_get(store, key)
+    if score is not None:
+        return float(score)
+    score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    cache_set(store, key, score, SCORE_LIFETIME)
+    return score
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    """Return score of user with given attributes, without the store"""
     score = 0
     if phone:
         score += 1.5
@@ -14,6 +142,25 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
     return score
 
 
+def interests_key(cid):
+    return "i:%s" % cid
+
+
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    if store is None:
+        interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+        return random.sample(interests, 2)
+    key = interests_key(cid)
+    r = flights.do(key, store.get, key)
+    return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids):
+    """Return dict {cid: interests} for unique cids, fetched from store in batches
+
+    Keys fetched by other threads at the same time are not fetched again"""
+    if store is None:
+        return {cid: get_interests(store, cid) for cid in cids}
+    keys = {cid: interests_key(cid) for cid in cids}
+    values = flights.do_many(keys.values(), store.get_many)
+    return {cid: json.loads(values[key]) if values[key] else [] for cid, key in keys.items()}
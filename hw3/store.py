@@ -1,30 +1,394 @@
-import redis
+import time
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import metrics
 
 DB_HOST = "192.168.99.100"
 DB_PORT = 6379
+DB_TIMEOUT = 0.2
+DB_MAX_CONNECTIONS = 10
+DB_RETRIES = 2
+DB_RETRY_BACKOFF = 0.01
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 10
+SQLITE_PATH = "./store.db"
+SQLITE_TIMEOUT = 5
+BACKENDS = ("redis", "memory", "sqlite")
+MGET_CHUNK_SIZE = 500
+# expired keys of memory and SQLite stores are deleted on writes at most once per SWEEP_INTERVAL seconds
+SWEEP_INTERVAL = 60
+CACHE_SIZE = 10000
+CACHE_TTL = 60
 
 
-def connect(host, port):
-    db = redis.StrictRedis(host=host, port=port, socket_timeout=1)
-    return db
+class StoreError(Exception):
+    pass
 
 
-db = connect(DB_HOST, DB_PORT)
+def connect(host, port, timeout, max_connections):
+    """Return Redis client using a bounded connection pool. No connection is made until the first command"""
+    # redis is imported here so the module (and its in-process cache) can be used without redis installed
+    import redis
+    pool = redis.BlockingConnectionPool(host=host, port=port, max_connections=max_connections,
+                                        timeout=timeout, socket_timeout=timeout, socket_connect_timeout=timeout)
+    return redis.StrictRedis(connection_pool=pool)
 
 
-def get(key, db=db):
-    return db.get(key)
+class CircuitBreaker:
+    """Stop calling a failing service for reset_timeout seconds after threshold failures in a row
 
+    After reset_timeout calls are allowed again ("half-open" state): a success closes the breaker,
+    a failure opens it for another reset_timeout"""
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
 
-def set(key, value, db=db):
-    return db.set(key, value)
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
 
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
 
-def cache_get(key):
-    pass
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
 
 
-def cache_set(key, value, lifetime):
-    pass
+class LRUCache:
+    """In-process LRU cache with per-key time to live and a bound on the number of keys"""
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return cached value or None if key is missing or expired"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, lifetime=None):
+        """Cache value for lifetime seconds (default ttl), evicting least recently used keys over maxsize"""
+        if lifetime is None:
+            lifetime = self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + lifetime)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._data)}
+
+
+class Store(ABC):
+    """Key-value storage interface
+
+    cache_get/cache_set go through an in-process LRUCache first, so repeated lookups
+    of the same key are served from memory"""
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else LRUCache()
+
+    @abstractmethod
+    def _get(self, key):
+        pass
+
+    @abstractmethod
+    def _mget(self, keys):
+        pass
+
+    @abstractmethod
+    def _set(self, key, value, lifetime):
+        pass
+
+    @abstractmethod
+    def _mset(self, items, lifetime):
+        pass
+
+    @property
+    def is_available(self):
+        """Return False if the storage should not be called, cache_* methods use the in-process cache only"""
+        return True
+
+    def get(self, key):
+        with metrics.STORE_LATENCY.time("get"):
+            return self._get(key)
+
+    def mget(self, keys):
+        """Return list of values of keys, None for missing keys"""
+        with metrics.STORE_LATENCY.time("mget"):
+            return self._mget(keys)
+
+    def set(self, key, value, lifetime=None):
+        """Set value of key, expiring in lifetime seconds if lifetime is given"""
+        with metrics.STORE_LATENCY.time("set"):
+            return self._set(key, value, lifetime)
+
+    def mset(self, items, lifetime=None):
+        """Set values of keys from dict items in one round trip, expiring in lifetime seconds if lifetime is given"""
+        with metrics.STORE_LATENCY.time("mset"):
+            return self._mset(items, lifetime)
+
+    def get_many(self, keys, chunk_size=MGET_CHUNK_SIZE):
+        """Return dict {key: value} for unique keys, fetched with one mget per chunk_size keys"""
+        keys = list(dict.fromkeys(keys))
+        values = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            values.update(zip(chunk, self.mget(chunk)))
+        return values
+
+    def set_many(self, items, lifetime=None, chunk_size=MGET_CHUNK_SIZE):
+        """Set values of keys from dict items with one mset per chunk_size keys"""
+        items = list(items.items())
+        for i in range(0, len(items), chunk_size):
+            self.mset(dict(items[i:i + chunk_size]), lifetime)
+
+    def cache_get(self, key):
+        value = self.cache.get(key)
+        if value is None and self.is_available:
+            value = self.get(key)
+            if value is not None:
+                self.cache.set(key, value)
+        return value
+
+    def cache_set(self, key, value, lifetime):
+        self.cache.set(key, value, lifetime)
+        if self.is_available:
+            self.set(key, value, lifetime)
+
+
+class RedisStore(Store):
+    """Key-value storage on top of Redis
+
+    Connection is made lazily on the first command. Failed commands are retried with exponential
+    backoff; after several failed commands the circuit breaker opens and the store stops calling Redis:
+    get/set raise StoreError and cache_get/cache_set use the in-process LRUCache only"""
+    def __init__(self, host=DB_HOST, port=DB_PORT, timeout=DB_TIMEOUT, max_connections=DB_MAX_CONNECTIONS,
+                 retries=DB_RETRIES, retry_backoff=DB_RETRY_BACKOFF, breaker=None, cache=None, connect=connect):
+        super().__init__(cache)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._connect = connect
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    self._db = self._connect(self.host, self.port, self.timeout, self.max_connections)
+        return self._db
+
+    @property
+    def is_available(self):
+        return not self.breaker.is_open
+
+    def _call(self, command, *args, **kwargs):
+        """Run Redis command with retries, raise StoreError if it fails or the breaker is open"""
+        if self.breaker.is_open:
+            raise StoreError("Store is unavailable: circuit breaker is open")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                result = (getattr(self.db, command) if isinstance(command, str) else command)(*args, **kwargs)
+            except Exception as e:
+                error = e
+            else:
+                self.breaker.success()
+                return result
+        self.breaker.failure()
+        raise StoreError("Store command %s failed after %s attempts: %s"
+                         % (getattr(command, "__name__", command), self.retries + 1, error))
+
+    def _get(self, key):
+        return self._call("get", key)
+
+    def _mget(self, keys):
+        return self._call("mget", keys)
+
+    def _set(self, key, value, lifetime):
+        return self._call("set", key, value, ex=lifetime)
+
+    def _mset(self, items, lifetime):
+        def mset():
+            pipeline = self.db.pipeline(transaction=False)
+            for key, value in items.items():
+                pipeline.set(key, value, ex=lifetime)
+            return pipeline.execute()
+        return self._call(mset)
+
+
+class MemoryStore(Store):
+    """Key-value storage in a dict of the current process"""
+    def __init__(self, cache=None, sweep_interval=SWEEP_INTERVAL):
+        super().__init__(cache)
+        self.sweep_interval = sweep_interval
+        self._data = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def _sweep(self, now):
+        """Delete expired keys if sweep_interval has passed since the last sweep. Called with the lock held"""
+        if now - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = now
+        expired = [key for key, (_, expires) in self._data.items() if expires is not None and expires <= now]
+        for key in expired:
+            del self._data[key]
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            with self._lock:
+                if self._data.get(key) is item:
+                    del self._data[key]
+            return None
+        return value
+
+    def _mget(self, keys):
+        return [self._get(key) for key in keys]
+
+    def _set(self, key, value, lifetime):
+        now = time.monotonic()
+        expires = now + lifetime if lifetime is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._sweep(now)
+        return True
+
+    def _mset(self, items, lifetime):
+        now = time.monotonic()
+        expires = now + lifetime if lifetime is not None else None
+        with self._lock:
+            for key, value in items.items():
+                self._data[key] = (value, expires)
+            self._sweep(now)
+        return True
+
+
+class SQLiteStore(Store):
+    """Key-value storage in SQLite database in WAL mode
+
+    Connections are kept in a pool and shared between threads"""
+    def __init__(self, path=SQLITE_PATH, timeout=SQLITE_TIMEOUT, cache=None, sweep_interval=SWEEP_INTERVAL):
+        super().__init__(cache)
+        self.path = path
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self._pool = queue.LifoQueue()
+        self._swept_at = time.monotonic()
+        self._sweep_lock = threading.Lock()
+
+    def _sweep(self, db):
+        """Delete expired rows if sweep_interval has passed since the last sweep"""
+        with self._sweep_lock:
+            now = time.monotonic()
+            if now - self._swept_at < self.sweep_interval:
+                return
+            self._swept_at = now
+        db.execute("DELETE FROM store WHERE expires <= ?", (time.time(),))
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value, expires REAL)")
+        return connection
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            yield connection
+        finally:
+            self._pool.put(connection)
+
+    def _get(self, key):
+        with self.connection() as db:
+            row = db.execute("SELECT value FROM store WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                             (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _mget(self, keys):
+        keys = list(keys)
+        with self.connection() as db:
+            rows = db.execute("SELECT key, value FROM store WHERE key IN (%s) AND (expires IS NULL OR expires > ?)"
+                              % ",".join("?" * len(keys)), keys + [time.time()]).fetchall()
+        values = dict(rows)
+        return [values.get(key) for key in keys]
+
+    def _set(self, key, value, lifetime):
+        expires = time.time() + lifetime if lifetime is not None else None
+        with self.connection() as db:
+            db.execute("INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+            self._sweep(db)
+        return True
+
+    def _mset(self, items, lifetime):
+        expires = time.time() + lifetime if lifetime is not None else None
+        with self.connection() as db:
+            db.execute("BEGIN")
+            try:
+                db.executemany("INSERT OR REPLACE INTO store (key, value, expires) VALUES (?, ?, ?)",
+                               [(key, value, expires) for key, value in items.items()])
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            self._sweep(db)
+        return True
 
 
+def create(backend, sqlite_path=SQLITE_PATH, **redis_params):
+    """Return store of backend (one of BACKENDS). redis_params are passed to RedisStore"""
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(sqlite_path)
+    if backend == "redis":
+        return RedisStore(**redis_params)
+    raise ValueError("Unknown store backend: %s" % backend)
@@ -1,7 +1,19 @@
+import gzip
+import http.client
+import io
+import json
+import threading
+import time
 import unittest
 from unittest.mock import patch
 
 from api import *
+import bulk
+import codec
+import loadtest
+import metrics
+import scoring
+import store
 
 
 class TestFieldObjects(unittest.TestCase):
@@ -70,6 +82,8 @@ class TestFieldObjects(unittest.TestCase):
         for g in GENDERS:
             self.assertEqual(GenderField().validate(g), "")
         self.assertEqual(GenderField().validate(""), "Gender must be a number %s, %s, %s" % (UNKNOWN, MALE, FEMALE))
+        for g in [[1], {"1": 1}]:
+            self.assertEqual(GenderField().validate(g), "Gender must be a number %s, %s, %s" % (UNKNOWN, MALE, FEMALE))
 
     def test_ClientIDsFieldClass(self):
         # test if super().validate() called
@@ -91,6 +105,9 @@ class TestRequestObjects(unittest.TestCase):
         self.assertIsInstance(test_request.schema["f2"], DateField)
         self.assertEqual(test_request.f1, "test_f1")
         self.assertIsNone(test_request.f2)
+        # field values are stored in slots
+        self.assertTupleEqual(TestRequest.__slots__, ("f1", "f2"))
+        self.assertRaises(AttributeError, setattr, test_request, "f3", "test_f3")
 
     def test_request_validation(self):
         # make testing classes
@@ -190,6 +207,33 @@ class TestClientsInterestsHandler(unittest.TestCase):
             self.assertIsInstance(interests, list)
             self.assertEqual(len(interests), 2)
 
+    def test_store_batch(self):
+        class Store:
+            def __init__(self):
+                self.calls = []
+
+            def get_many(self, keys):
+                keys = list(keys)
+                self.calls.append(keys)
+                return {key: '["cars", "pets"]' if key == "i:1" else None for key in keys}
+
+        store = Store()
+        self.request["arguments"]["client_ids"] = [1, 2, 1, 3]
+        method_request = MethodRequest(self.request)
+        response = ClientsInterestsRequest(method_request.arguments).handle(self.ctx, store)
+        self.assertTupleEqual(response, ({"1": ["cars", "pets"], "2": [], "3": []}, OK))
+        self.assertListEqual(store.calls, [["i:1", "i:2", "i:3"]])
+
+    def test_streaming(self):
+        self.request["arguments"]["client_ids"] = list(range(STREAM_MIN_CLIENTS)) + [0]
+        method_request = MethodRequest(self.request)
+        response, code = ClientsInterestsRequest(method_request.arguments).handle(self.ctx, self.store)
+        self.assertEqual(code, OK)
+        self.assertIsInstance(response, StreamingResponse)
+        parts = list(response.parts)
+        self.assertEqual(len(parts), STREAM_MIN_CLIENTS // STREAM_CHUNK_SIZE)
+        self.assertEqual(sum(len(part) for part in parts), STREAM_MIN_CLIENTS)
+
     def test_validation_error(self):
         self.request["arguments"] = {"client_ids": [1,2,3,4], "date": "99.99.1900"}
         method_request = MethodRequest(self.request)
@@ -197,6 +241,111 @@ class TestClientsInterestsHandler(unittest.TestCase):
         self.assertTupleEqual(response, ({"date": "Date must have format: DD.MM.YYYY"}, INVALID_REQUEST))
 
 
+class TestScoring(unittest.TestCase):
+    class DictStore:
+        def __init__(self):
+            self.data = {}
+
+        def cache_get(self, key):
+            return self.data.get(key)
+
+        def cache_set(self, key, value, lifetime):
+            self.data[key] = value
+
+    class BrokenStore:
+        def cache_get(self, key):
+            raise ConnectionError("store is down")
+
+        def cache_set(self, key, value, lifetime):
+            raise ConnectionError("store is down")
+
+    def test_score_cached(self):
+        store = self.DictStore()
+        self.assertEqual(scoring.get_score(store, phone="79175002040", email="a@b.c"), 3.0)
+        key = scoring.score_key(phone="79175002040", email="a@b.c")
+        self.assertEqual(store.data, {key: 3.0})
+        store.data[key] = 4.5
+        self.assertEqual(scoring.get_score(store, phone="79175002040", email="a@b.c"), 4.5)
+
+    def test_score_key(self):
+        self.assertEqual(scoring.score_key(phone=79175002040, first_name="A"),
+                         scoring.score_key(phone="79175002040", first_name="A"))
+        self.assertNotEqual(scoring.score_key(first_name="AB", last_name="C"),
+                            scoring.score_key(first_name="A", last_name="BC"))
+
+    def test_store_failure(self):
+        with self.assertLogs(level="ERROR"):
+            score = scoring.get_score(self.BrokenStore(), phone="79175002040", email="a@b.c")
+        self.assertEqual(score, 3.0)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.flight = scoring.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def fetch(self, *keys):
+        self.calls.append(keys)
+        self.release.wait(5)
+        return {key: key.upper() for key in keys}
+
+    def start(self, target, *args, followers=0):
+        """Start thread with target(*args), wait until it is in flight with followers waiting"""
+        results = []
+        thread = threading.Thread(target=lambda: results.append(target(*args)))
+        thread.start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            calls = list(self.flight._calls.values())
+            if calls and sum(call.waiters for call in calls) >= followers:
+                break
+            time.sleep(0.001)
+        return thread, results
+
+    def test_do(self):
+        leader, leader_results = self.start(self.flight.do, "a", self.fetch, "a")
+        followers = [self.start(self.flight.do, "a", self.fetch, "a", followers=i + 1) for i in range(3)]
+        self.release.set()
+        for thread, results in [(leader, leader_results)] + followers:
+            thread.join()
+            self.assertListEqual(results, [{"a": "A"}])
+        self.assertListEqual(self.calls, [("a",)])
+        self.assertDictEqual(self.flight._calls, {})
+
+    def test_do_many(self):
+        leader, _ = self.start(self.flight.do_many, ["a", "b"], lambda keys: self.fetch(*keys))
+        follower, results = self.start(self.flight.do_many, ["b", "c", "c"], lambda keys: self.fetch(*keys),
+                                       followers=1)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertDictEqual(results[0], {"b": "B", "c": "C"})
+        self.assertListEqual(self.calls, [("a", "b"), ("c",)])
+
+    def test_error_shared(self):
+        def fail():
+            self.calls.append(1)
+            self.release.wait(5)
+            raise ConnectionError("store is down")
+
+        errors = []
+
+        def call():
+            try:
+                self.flight.do("a", fail)
+            except ConnectionError as e:
+                errors.append(e)
+
+        leader, _ = self.start(call)
+        follower, _ = self.start(call, followers=1)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(len(self.calls), 1)
+
+
 class TestMethodHandler(unittest.TestCase):
     def setUp(self):
         self.ctx = {}
@@ -234,5 +383,515 @@ class TestMethodHandler(unittest.TestCase):
         assert mock_method.called
 
 
+class TestCheckAuth(unittest.TestCase):
+    def setUp(self):
+        verified_tokens._data.clear()
+        self.token = hashlib.sha512(("horns&hoofs" + "h&f" + SALT).encode()).hexdigest()
+
+    def test_user_token_cached(self):
+        request = MethodRequest({"account": "horns&hoofs", "login": "h&f", "token": self.token})
+        with patch("api.hashlib.sha512", wraps=hashlib.sha512) as mock_sha:
+            self.assertTrue(check_auth(request))
+            self.assertTrue(check_auth(request))
+        self.assertEqual(mock_sha.call_count, 1)
+
+    def test_invalid_token_not_cached(self):
+        for token in ["bad", "", "нет", self.token.upper()]:
+            request = MethodRequest({"account": "horns&hoofs", "login": "h&f", "token": token})
+            self.assertFalse(check_auth(request))
+        self.assertEqual(len(verified_tokens), 0)
+
+    @patch("api.store.time.monotonic", return_value=1000)
+    def test_admin_token_expires(self, mock_time):
+        now = datetime.datetime.now()
+        token = hashlib.sha512((now.strftime("%Y%m%d%H") + ADMIN_SALT).encode()).hexdigest()
+        request = MethodRequest({"login": ADMIN_LOGIN, "token": token})
+        self.assertTrue(check_auth(request))
+        self.assertTrue(verified_tokens.get((None, ADMIN_LOGIN, token)))
+        # cached token expires not later than at the end of the hour
+        mock_time.return_value = 1000 + 60 * 60
+        self.assertIsNone(verified_tokens.get((None, ADMIN_LOGIN, token)))
+
+
+class TestBatchHandler(unittest.TestCase):
+    def setUp(self):
+        self.ctx = {}
+        self.store = None
+        token = hashlib.sha512(("horns&hoofs" + "h&f" + SALT).encode()).hexdigest()
+        self.valid = {"account": "horns&hoofs", "login": "h&f", "token": token, "method": "online_score",
+                      "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+
+    def get_response(self, body):
+        return method_handler({"body": body, "headers": {}}, self.ctx, self.store)
+
+    def test_batch(self):
+        invalid_token = dict(self.valid, token="bad")
+        invalid_arguments = dict(self.valid, arguments={"phone": "1"})
+        response, code = self.get_response([self.valid, invalid_token, invalid_arguments, 1, [], self.valid])
+        self.assertEqual(code, OK)
+        self.assertListEqual(response, [
+            {"code": OK, "response": {"score": 3.0}},
+            {"code": FORBIDDEN, "error": ERRORS[FORBIDDEN]},
+            {"code": INVALID_REQUEST, "error": {"phone": "Field must be a valid phone",
+                                                "online_score": OnlineScoreRequest({}).validate()["online_score"]}},
+            {"code": BAD_REQUEST, "error": ERRORS[BAD_REQUEST]},
+            {"code": BAD_REQUEST, "error": ERRORS[BAD_REQUEST]},
+            {"code": OK, "response": {"score": 3.0}},
+        ])
+        self.assertEqual(len(self.ctx["batch"]), 6)
+        self.assertListEqual(sorted(self.ctx["batch"][0]["has"]), ["email", "phone"])
+
+    @patch("api.check_auth", return_value=True)
+    def test_auth_reused(self, mock_auth):
+        self.get_response([self.valid] * 100)
+        # concurrent requests may check the same token before the result is cached
+        self.assertLessEqual(mock_auth.call_count, BATCH_WORKERS)
+
+    def test_streaming_in_batch(self):
+        request = dict(self.valid, method="clients_interests",
+                       arguments={"client_ids": list(range(STREAM_MIN_CLIENTS))})
+        response, code = self.get_response([request, request])
+        self.assertEqual(len(response[1]["response"]), STREAM_MIN_CLIENTS)
+
+    def test_batch_size(self):
+        _, code = self.get_response([self.valid] * (MAX_BATCH_SIZE + 1))
+        self.assertEqual(code, INVALID_REQUEST)
+
+
+class TestHTTPHandler(unittest.TestCase):
+    def make_handler(self, body=b"", headers=None, version="HTTP/1.1"):
+        handler = MainHTTPHandler.__new__(MainHTTPHandler)
+        handler.rfile = io.BytesIO(body)
+        handler.wfile = io.BytesIO()
+        handler.headers = {"Content-Length": str(len(body))} if headers is None else headers
+        handler.path = "/method/"
+        handler.command = "POST"
+        handler.request_version = version
+        handler.requestline = "POST /method/ " + version
+        handler.client_address = ("127.0.0.1", 0)
+        handler.close_connection = False
+        return handler
+
+    def test_body_too_large(self):
+        handler = self.make_handler(b"{}", headers={"Content-Length": str(MAX_BODY_SIZE + 1)})
+        self.assertTupleEqual(handler.handle_post({}), ({}, REQUEST_ENTITY_TOO_LARGE))
+        self.assertTrue(handler.close_connection)
+        self.assertEqual(handler.rfile.tell(), 0)
+
+    def test_bad_content_length(self):
+        for headers in [{}, {"Content-Length": "abc"}, {"Content-Length": "-1"}]:
+            handler = self.make_handler(b"{}", headers=headers)
+            self.assertTupleEqual(handler.handle_post({}), ({}, BAD_REQUEST))
+            self.assertTrue(handler.close_connection)
+            self.assertEqual(handler.rfile.tell(), 0)
+
+    def test_send_stream(self):
+        response = StreamingResponse(iter([{"1": ["a"]}, {}, {"2": ["b"], "3": []}]))
+        handler = self.make_handler()
+        handler.send_result(response, OK, {})
+        head, body = handler.wfile.getvalue().split(b"\r\n\r\n", 1)
+        self.assertIn(b"Transfer-Encoding: chunked", head)
+        data = b""
+        while True:
+            size, body = body.split(b"\r\n", 1)
+            if int(size, 16) == 0:
+                break
+            data, body = data + body[:int(size, 16)], body[int(size, 16) + 2:]
+        self.assertDictEqual(json.loads(data), {"response": {"1": ["a"], "2": ["b"], "3": []}, "code": OK})
+
+    def test_cached_error_responses(self):
+        body = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "bad",
+                "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        for path, code in [("/method/", FORBIDDEN), ("/unknown/", NOT_FOUND)]:
+            handler = self.make_handler(json.dumps(body).encode())
+            handler.path = path
+            with patch.object(handler, "send_body") as send_body, self.assertLogs(level="INFO"):
+                handler.handle_method_request()
+            self.assertIs(send_body.call_args[0][1], ERROR_RESPONSES[code])
+
+    def test_content_length(self):
+        handler = self.make_handler()
+        handler.send_result({"score": 3.0}, OK, {})
+        head, body = handler.wfile.getvalue().split(b"\r\n\r\n", 1)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200"))
+        self.assertIn(b"Content-Length: %d" % len(body), head)
+        self.assertDictEqual(json.loads(body), {"response": {"score": 3.0}, "code": OK})
+
+    def test_gzip(self):
+        response = {str(cid): ["cars", "pets"] for cid in range(100)}
+        for accept_encoding, min_size, compressed in [("gzip, deflate", 100, True),
+                                                      ("gzip;q=0", 100, False),
+                                                      (None, 100, False),
+                                                      ("gzip", None, False),
+                                                      ("gzip", 100000, False)]:
+            handler = self.make_handler(headers={"Accept-Encoding": accept_encoding})
+            handler.gzip_min_size = min_size
+            handler.send_result(response, OK, {})
+            head, body = handler.wfile.getvalue().split(b"\r\n\r\n", 1)
+            self.assertEqual(b"Content-Encoding: gzip" in head, compressed)
+            self.assertIn(b"Content-Length: %d" % len(body), head)
+            if compressed:
+                body = gzip.decompress(body)
+            self.assertDictEqual(json.loads(body)["response"], response)
+
+    def test_accepts_gzip(self):
+        for value, expected in [("gzip", True), ("deflate, GZIP;q=0.5", True), ("*", True),
+                                ("gzip;q=0", False), ("gzip; q=0.0", False), ("deflate", False), ("", False),
+                                (None, False)]:
+            self.assertEqual(accepts_gzip(value), expected, value)
+
+    def test_admission(self):
+        handler = self.make_handler(b"{}")
+        handler.admission = threading.BoundedSemaphore(1)
+        handler.admission.acquire()
+        handler.do_POST()
+        head, body = handler.wfile.getvalue().split(b"\r\n\r\n", 1)
+        self.assertTrue(head.startswith(b"HTTP/1.1 503"))
+        self.assertEqual(body, ERROR_RESPONSES[SERVICE_UNAVAILABLE])
+        self.assertTrue(handler.close_connection)
+        # the slot is released after request
+        handler.admission.release()
+        handler = self.make_handler(b"{}")
+        handler.admission = threading.BoundedSemaphore(1)
+        with self.assertLogs(level="INFO"):
+            handler.do_POST()
+        self.assertTrue(handler.admission.acquire(blocking=False))
+
+    @patch("api.time.monotonic", return_value=100)
+    def test_rate_limit(self, mock_time):
+        body = json.dumps([{"login": "a", "token": loadtest.make_token(None, "a")},
+                           {"login": "a", "token": loadtest.make_token(None, "a")},
+                           {"login": "b", "token": loadtest.make_token(None, "b")}]).encode()
+        handler = self.make_handler(body)
+        handler.rate_limiter = RateLimiter(rate=1, burst=2)
+        self.assertEqual(handler.handle_post({"request_id": "id"})[1], OK)
+        handler = self.make_handler(body)
+        handler.rate_limiter = RateLimiter(rate=1, burst=1)
+        self.assertTupleEqual(handler.handle_post({}), ({}, TOO_MANY_REQUESTS))
+
+    @patch("api.time.monotonic", return_value=100)
+    def test_rate_limit_forged_token(self, mock_time):
+        rate_limiter = RateLimiter(rate=1, burst=1)
+
+        def post(token, address):
+            body = {"login": ADMIN_LOGIN, "token": token, "method": "online_score",
+                    "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+            handler = self.make_handler(json.dumps(body).encode())
+            handler.client_address = (address, 0)
+            handler.rate_limiter = rate_limiter
+            return handler.handle_post({"request_id": "id"})[1]
+
+        self.assertEqual(post("bad", "10.0.0.1"), FORBIDDEN)
+        self.assertEqual(post("bad", "10.0.0.1"), TOO_MANY_REQUESTS)
+        self.assertEqual(post(loadtest.make_token(None, ADMIN_LOGIN), "10.0.0.2"), OK)
+
+    def test_send_stream_http10(self):
+        handler = self.make_handler(version="HTTP/1.0")
+        handler.send_result(StreamingResponse(iter([])), OK, {})
+        head, body = handler.wfile.getvalue().split(b"\r\n\r\n", 1)
+        self.assertNotIn(b"chunked", head)
+        self.assertDictEqual(json.loads(body), {"response": {}, "code": OK})
+        self.assertTrue(handler.close_connection)
+
+    def test_keepalive(self):
+        for threaded in [True, False]:
+            server = make_server("localhost", 0, threaded)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            connections = [http.client.HTTPConnection("localhost", server.server_address[1], timeout=3)
+                           for _ in range(2)]
+            try:
+                for connection in connections:
+                    connection.request("GET", "/metrics")
+                    response = connection.getresponse()
+                    response.read()
+                    self.assertEqual(response.status, OK)
+                    self.assertEqual(response.will_close, not threaded)
+                if threaded:
+                    # the first connection is still open
+                    connections[0].request("GET", "/metrics")
+                    self.assertEqual(connections[0].getresponse().status, OK)
+            finally:
+                for connection in connections:
+                    connection.close()
+                server.shutdown()
+                server.server_close()
+
+    def test_server_log_levels(self):
+        handler = self.make_handler()
+        with self.assertLogs(level="WARNING") as cm:
+            handler.send_error(BAD_REQUEST, "Bad request syntax")
+        self.assertIn("code 400, message Bad request syntax", cm.output[0])
+        with self.assertNoLogs(level="INFO"):
+            handler.log_request(OK)
+
+    def test_request_log(self):
+        handler = self.make_handler(json.dumps({"login": "h&f", "method": "online_score"}).encode())
+        with self.assertLogs(level="INFO") as cm:
+            handler.handle_method_request()
+        entry = json.loads(cm.output[-1].split(":", 2)[2])
+        self.assertEqual(entry["method"], "unknown")
+        self.assertEqual(entry["code"], INVALID_REQUEST)
+        self.assertIsInstance(entry["elapsed"], float)
+
+
+class TestRateLimiter(unittest.TestCase):
+    @patch("api.time.monotonic", return_value=100)
+    def test_token_bucket(self, mock_time):
+        limiter = RateLimiter(rate=2, burst=3)
+        self.assertTrue(limiter.allow("a", 3))
+        self.assertFalse(limiter.allow("a"))
+        self.assertTrue(limiter.allow("b"))
+        mock_time.return_value = 100.5
+        self.assertTrue(limiter.allow("a"))
+        self.assertFalse(limiter.allow("a"))
+        # not more than burst tokens are accumulated
+        mock_time.return_value = 200
+        self.assertFalse(limiter.allow("a", 4))
+        self.assertTrue(limiter.allow("a", 3))
+
+    def test_maxsize(self):
+        limiter = RateLimiter(rate=1, burst=1, maxsize=2)
+        for key in ["a", "b", "c"]:
+            limiter.allow(key)
+        self.assertListEqual(list(limiter._buckets), ["b", "c"])
+
+    def test_rate_limit_keys(self):
+        token = loadtest.make_token("acc", "a")
+        self.assertDictEqual(rate_limit_keys({"account": "acc", "login": "a", "token": token}, "1.2.3.4"),
+                             {"login:a": 1})
+        body = [{"account": "acc", "login": "a", "token": token}, {"login": "b", "token": "bad"},
+                {"account": "acc", "login": "a", "token": token}, {"login": 1}, 2, []]
+        self.assertDictEqual(rate_limit_keys(body, "1.2.3.4"), {"login:a": 2, "address:1.2.3.4": 4})
+
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.obj = {"response": {str(cid): ["cars", "интересы"] for cid in range(1000)}, "code": OK}
+
+    def test_loads_dumps(self):
+        self.assertEqual(codec.loads(codec.dumps(self.obj)), self.obj)
+        self.assertEqual(codec.loads('{"a": [1, 2.5, null]}'), {"a": [1, 2.5, None]})
+        self.assertRaises(ValueError, codec.loads, b"{bad json")
+
+    def test_error_responses(self):
+        for code, data in ERROR_RESPONSES.items():
+            self.assertDictEqual(codec.loads(data), {"error": ERRORS[code], "code": code})
+
+
+class TestLogging(unittest.TestCase):
+    def test_json_formatter(self):
+        context = {"request_id": "id", "code": OK, "response": {"score": 3.0}}
+        record = logging.makeLogRecord({"msg": context, "levelname": "INFO", "context": context})
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry.pop("level"), "INFO")
+        self.assertIsInstance(entry.pop("time"), str)
+        self.assertDictEqual(entry, context)
+        record = logging.makeLogRecord({"msg": "Starting server at %s", "args": (8080,), "levelname": "INFO"})
+        self.assertEqual(json.loads(JsonFormatter().format(record))["message"], "Starting server at 8080")
+
+    def test_queue_handler(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        context = {"code": OK}
+        record = logging.makeLogRecord({"msg": context, "levelno": logging.INFO, "context": context})
+        handler.handle(record)
+        handler.handle(record)
+        self.assertIs(handler.queue.get_nowait(), record)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_queue_handler_keeps_errors(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        context = {"code": OK}
+        handler.handle(logging.makeLogRecord({"msg": context, "levelno": logging.INFO, "context": context}))
+        error_context = {"code": BAD_REQUEST}
+        records = [logging.makeLogRecord({"msg": error_context, "levelno": logging.INFO, "context": error_context}),
+                   logging.makeLogRecord({"msg": "Unexpected error", "levelno": logging.ERROR})]
+        received = []
+
+        def consume():
+            for _ in range(3):
+                received.append(handler.queue.get(timeout=5))
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for record in records:
+            handler.handle(record)
+        consumer.join()
+        self.assertListEqual([record.getMessage() for record in received[1:]],
+                             [record.getMessage() for record in records])
+        self.assertEqual(handler.dropped, 0)
+
+    @patch("api.random.random", return_value=0.5)
+    def test_sampling(self, mock_random):
+        with self.assertLogs(level="INFO") as cm:
+            log_request({"code": OK}, OK, sample_rate=0.6)
+            log_request({"code": OK, "skipped": True}, OK, sample_rate=0.4)
+            log_request({"code": BAD_REQUEST}, BAD_REQUEST, sample_rate=0)
+        self.assertListEqual([json.loads(line.split(":", 2)[2]) for line in cm.output],
+                             [{"code": OK}, {"code": BAD_REQUEST}])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "Test counter", ("method", "code"))
+        metrics.registry.remove(counter)
+        counter.inc("online_score", 200)
+        counter.inc("online_score", 200)
+        counter.inc("a\"b", 404)
+        self.assertEqual(counter.render(), "# HELP test_total Test counter\n"
+                                           "# TYPE test_total counter\n"
+                                           'test_total{method="a\\"b",code="404"} 1\n'
+                                           'test_total{method="online_score",code="200"} 2')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test histogram", ("stage",), buckets=(0.1, 1.0))
+        metrics.registry.remove(histogram)
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value, "auth")
+        self.assertListEqual(histogram.render().split("\n")[2:],
+                             ['test_seconds_bucket{stage="auth",le="0.1"} 2',
+                              'test_seconds_bucket{stage="auth",le="1.0"} 3',
+                              'test_seconds_bucket{stage="auth",le="+Inf"} 4',
+                              'test_seconds_sum{stage="auth"} 2.65',
+                              'test_seconds_count{stage="auth"} 4'])
+
+    def test_method_handler_stages(self):
+        metrics.STAGE_LATENCY.clear()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "token": hashlib.sha512(("horns&hoofs" + "h&f" + SALT).encode()).hexdigest(),
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        ctx = {}
+        method_handler({"body": request, "headers": {}}, ctx, None)
+        self.assertEqual(ctx["method"], "online_score")
+        for stage in ["validation", "auth", "scoring"]:
+            self.assertIsNotNone(metrics.STAGE_LATENCY.get("online_score", stage))
+        method_handler({"body": dict(request, method="other"), "headers": {}}, ctx, None)
+        self.assertIsNotNone(metrics.STAGE_LATENCY.get("unknown", "auth"))
+
+    def test_metrics_handler(self):
+        class Store:
+            cache = store.LRUCache()
+
+        Store.cache.set("a", 1)
+        Store.cache.get("a")
+        Store.cache.get("b")
+        text, code = metrics_handler({}, {}, Store())
+        self.assertEqual(code, OK)
+        self.assertIn("store_cache_hit_ratio 0.5\n", text)
+        self.assertIn("# TYPE api_requests_in_flight gauge\n", text)
+
+
+class TestLoadtest(unittest.TestCase):
+    def test_requests_valid(self):
+        bodies = loadtest.make_bodies("mixed", 10, users=5, clients=3, batch=2)
+        store = loadtest.make_store(users=5)
+        for body in bodies:
+            response, code = method_handler({"body": json.loads(body), "headers": {}}, {}, store)
+            self.assertEqual(code, OK)
+            self.assertListEqual([r["code"] for r in response], [OK, OK])
+
+    def test_admin_token(self):
+        request = MethodRequest({"login": ADMIN_LOGIN, "token": loadtest.make_token(None, ADMIN_LOGIN)})
+        self.assertTrue(check_auth(request))
+
+    def test_keepalive_latency(self):
+        # without TCP_NODELAY the body of a kept-alive response waits for a delayed ACK (~40 ms)
+        MainHTTPHandler.store = loadtest.make_store(users=5)
+        server = make_server("localhost", 0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            bodies = loadtest.make_bodies("mixed", 50, users=5, clients=3, batch=1)
+            latencies, errors, elapsed = loadtest.run("localhost", server.server_address[1], bodies, concurrency=1)
+        finally:
+            server.shutdown()
+            server.server_close()
+            MainHTTPHandler.store = None
+        self.assertEqual(errors, 0)
+        self.assertLess(loadtest.report(latencies, errors, elapsed)["p50_ms"], 20)
+
+    def test_report(self):
+        latencies = [i / 1000.0 for i in range(100, 0, -1)]
+        self.assertDictEqual(loadtest.report(latencies, 1, 2.0),
+                             {"requests": 100, "errors": 1, "rps": 50.0, "p50_ms": 50.0, "p95_ms": 95.0,
+                              "p99_ms": 99.0})
+
+
+class TestBulk(unittest.TestCase):
+    LINES = [b'{"phone": "79175002040", "email": "stupnikov@otus.ru"}\n',
+             b'\n',
+             b'{"phone": "89175002040", "email": "stupnikov@otus.ru"}\n',
+             b'not json\n',
+             b'[1, 2]\n',
+             b'{"gender": 1, "birthday": "01.01.2000", "first_name": "a", "last_name": "b"}\n']
+
+    def run_bulk(self, method, lines, workers=1, batch_size=2, backend="memory"):
+        output = io.BytesIO()
+        bulk.main(method, lines, output, workers, batch_size, backend, {})
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_online_score(self):
+        responses = self.run_bulk("online_score", self.LINES)
+        self.assertListEqual([r["code"] for r in responses],
+                             [OK, BAD_REQUEST, INVALID_REQUEST, BAD_REQUEST, BAD_REQUEST, OK])
+        self.assertEqual(responses[0]["response"], {"score": 3.0})
+        self.assertEqual(responses[5]["response"], {"score": 2.0})
+
+    def test_validator_error(self):
+        lines = [b'{"gender": [1], "birthday": "01.01.2000"}\n', self.LINES[0]]
+        with patch.object(OnlineScoreRequest, "validate", side_effect=[TypeError("unhashable"), {}]), \
+                self.assertLogs(level="ERROR"):
+            responses = self.run_bulk("online_score", lines, batch_size=10)
+        self.assertListEqual([r["code"] for r in responses], [INVALID_REQUEST, OK])
+        responses = self.run_bulk("online_score", lines, batch_size=10)
+        self.assertListEqual([r["code"] for r in responses], [INVALID_REQUEST, OK])
+        self.assertIn("gender", responses[0]["error"])
+
+    def test_online_score_store_calls(self):
+        class CountingStore(store.MemoryStore):
+            def __init__(self):
+                super().__init__()
+                self.calls = []
+
+            def get(self, key):
+                self.calls.append("get")
+                return super().get(key)
+
+            def mget(self, keys):
+                self.calls.append("mget")
+                return super().mget(keys)
+
+            def set(self, key, value, lifetime=None):
+                self.calls.append("set")
+                return super().set(key, value, lifetime)
+
+            def mset(self, items, lifetime=None):
+                self.calls.append("mset")
+                return super().mset(items, lifetime)
+
+        db = CountingStore()
+        db.set(scoring.score_key("79175002040", "stupnikov@otus.ru"), "7.5")
+        del db.calls[:]
+        lines = [self.LINES[0]] + [codec.dumps({"phone": "7%010d" % i, "email": "user@otus.ru"}) for i in range(100)]
+        responses = bulk.score_batch(lines, db)
+        self.assertEqual(responses[0]["response"], {"score": 7.5})
+        self.assertTrue(all(r["response"] == {"score": 3.0} for r in responses[1:]))
+        self.assertListEqual(db.calls, ["mget", "mset"])
+        self.assertEqual(db.get(scoring.score_key("70000000099", "user@otus.ru")), 3.0)
+
+    def test_clients_interests(self):
+        lines = [b'{"client_ids": [1, 2], "date": "20.07.2017"}', b'{"date": "20.07.2017"}', b'{"client_ids": [2, 3]}']
+        responses = bulk.interests_batch(lines, loadtest.make_store(users=5))
+        self.assertListEqual([r["code"] for r in responses], [OK, INVALID_REQUEST, OK])
+        self.assertListEqual(sorted(responses[0]["response"]), ["1", "2"])
+        self.assertEqual(responses[0]["response"]["2"], responses[2]["response"]["2"])
+
+    def test_pool_keeps_order(self):
+        lines = [codec.dumps({"phone": "7%010d" % i, "email": "user@otus.ru", "first_name": "a",
+                              "last_name": "b" if i % 2 else None}) for i in range(20)]
+        responses = self.run_bulk("online_score", lines, workers=2, batch_size=3, backend="none")
+        self.assertListEqual([r["response"]["score"] for r in responses], [3.5 if i % 2 else 3.0 for i in range(20)])
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,262 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import store
+
+
+class FakeRedis:
+    """Dict-based stand-in for redis.StrictRedis"""
+    def __init__(self):
+        self.data = {}
+        self.calls = 0
+        self.down = False
+
+    def _command(self):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError("Connection refused")
+
+    def get(self, key):
+        self._command()
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self._command()
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self._command()
+        self.data[key] = str(value).encode()
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Buffers set commands, executes them as one command of FakeRedis"""
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value))
+
+    def execute(self):
+        self.redis._command()
+        for key, value in self.commands:
+            self.redis.data[key] = str(value).encode()
+        return [True] * len(self.commands)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_hit_and_miss(self):
+        cache = store.LRUCache(maxsize=2)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertDictEqual(cache.stats(), {"hits": 1, "misses": 1, "evictions": 0, "size": 1})
+
+    def test_eviction(self):
+        cache = store.LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # "b" becomes least recently used
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    @patch("store.time.monotonic")
+    def test_ttl(self, mock_time):
+        cache = store.LRUCache(ttl=10)
+        mock_time.return_value = 100
+        cache.set("default", 1)
+        cache.set("short", 2, lifetime=1)
+        mock_time.return_value = 105
+        self.assertIsNone(cache.get("short"))
+        self.assertEqual(cache.get("default"), 1)
+        mock_time.return_value = 111
+        self.assertIsNone(cache.get("default"))
+        self.assertEqual(len(cache), 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    @patch("store.time.monotonic", return_value=100)
+    def test_open_and_reset(self, mock_time):
+        breaker = store.CircuitBreaker(threshold=2, reset_timeout=10)
+        breaker.failure()
+        self.assertFalse(breaker.is_open)
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        # half-open after reset_timeout
+        mock_time.return_value = 110
+        self.assertFalse(breaker.is_open)
+        # a failed trial call opens the breaker again
+        breaker.failure()
+        self.assertTrue(breaker.is_open)
+        mock_time.return_value = 120
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_concurrent_failures(self):
+        breaker = store.CircuitBreaker(threshold=10 ** 6)
+
+        def fail():
+            for _ in range(10000):
+                breaker.failure()
+
+        threads = [threading.Thread(target=fail) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(breaker.failures, 80000)
+
+
+class TestRedisStore(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeRedis()
+        self.connections = []
+        self.store = store.RedisStore(retries=2, retry_backoff=0, breaker=store.CircuitBreaker(threshold=2),
+                                 connect=self.connect)
+
+    def connect(self, host, port, timeout, max_connections):
+        self.connections.append((host, port, timeout, max_connections))
+        return self.db
+
+    def test_lazy_connect(self):
+        self.assertListEqual(self.connections, [])
+        self.store.get("key")
+        self.store.get("key")
+        self.assertListEqual(self.connections,
+                             [(store.DB_HOST, store.DB_PORT, store.DB_TIMEOUT, store.DB_MAX_CONNECTIONS)])
+
+    def test_retries(self):
+        self.db.down = True
+        self.assertRaises(store.StoreError, self.store.get, "key")
+        self.assertEqual(self.db.calls, 3)
+
+    def test_breaker_open(self):
+        self.store.cache_set("cached", 1.5, 60)
+        self.db.down = True
+        for _ in range(2):
+            self.assertRaises(store.StoreError, self.store.get, "key")
+        self.assertTrue(self.store.breaker.is_open)
+        calls = self.db.calls
+        # store is not called while the breaker is open, cache_* methods use the in-process cache only
+        self.assertRaises(store.StoreError, self.store.get, "key")
+        self.assertEqual(self.store.cache_get("cached"), 1.5)
+        self.assertIsNone(self.store.cache_get("key"))
+        self.store.cache_set("key", 3.0, 60)
+        self.assertEqual(self.store.cache_get("key"), 3.0)
+        self.assertEqual(self.db.calls, calls)
+
+    def test_get_many(self):
+        self.db.data.update({"a": b"1", "c": b"3"})
+        self.assertDictEqual(self.store.get_many(["a", "b", "c", "a", "b"], chunk_size=2),
+                             {"a": b"1", "b": None, "c": b"3"})
+        self.assertEqual(self.db.calls, 2)
+
+    def test_cache_set_writes_through(self):
+        self.store.cache_set("key", 1.5, 60)
+        self.assertEqual(self.db.data["key"], b"1.5")
+        self.assertEqual(self.store.cache_get("key"), 1.5)
+        self.assertEqual(self.db.calls, 1)
+
+    def test_set_many_pipelined(self):
+        self.store.set_many({"a": 1, "b": 2, "c": 3}, 60, chunk_size=2)
+        self.assertDictEqual(self.db.data, {"a": b"1", "b": b"2", "c": b"3"})
+        self.assertEqual(self.db.calls, 2)
+
+    def test_cache_get_from_db(self):
+        self.db.data["key"] = b"3.0"
+        self.assertEqual(self.store.cache_get("key"), b"3.0")
+        self.assertEqual(self.store.cache_get("key"), b"3.0")
+        self.assertEqual(self.db.calls, 1)
+        self.assertIsNone(self.store.cache_get("missing"))
+
+
+class StoreTestMixin:
+    """Tests of a store backend. setUp must set self.store"""
+    def test_get_set(self):
+        self.assertIsNone(self.store.get("key"))
+        self.store.set("key", "value")
+        self.assertEqual(self.store.get("key"), "value")
+        self.store.set("key", 1.5)
+        self.assertEqual(self.store.get("key"), 1.5)
+
+    def test_mget(self):
+        self.store.set("a", "1")
+        self.store.set("c", "3")
+        self.assertListEqual(self.store.mget(["a", "b", "c"]), ["1", None, "3"])
+        self.assertDictEqual(self.store.get_many(["a", "b", "c", "a"], chunk_size=2), {"a": "1", "b": None, "c": "3"})
+
+    def test_set_many(self):
+        self.store.set_many({"a": "1", "b": "2", "c": "3"}, 60, chunk_size=2)
+        self.assertListEqual(self.store.mget(["a", "b", "c"]), ["1", "2", "3"])
+        self.store.set_many({"a": "4"}, lifetime=-1)
+        self.assertIsNone(self.store.get("a"))
+
+    def test_sweep(self):
+        self.store.set("expired", "value", lifetime=-1)
+        self.store.set("key", "value")
+        self.assertListEqual(self.stored_keys(), ["expired", "key"])
+        self.store.sweep_interval = 0
+        self.store.set_many({"other": "value"}, lifetime=60)
+        self.assertListEqual(self.stored_keys(), ["key", "other"])
+
+    def test_lifetime(self):
+        self.store.set("key", "value", lifetime=-1)
+        self.assertIsNone(self.store.get("key"))
+        self.assertListEqual(self.store.mget(["key"]), [None])
+
+    def test_cache(self):
+        self.store.cache_set("key", "value", 60)
+        self.assertEqual(self.store.get("key"), "value")
+        self.assertEqual(self.store.cache_get("key"), "value")
+        self.assertEqual(self.store.cache.hits, 1)
+
+
+class TestMemoryStore(StoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.store = store.MemoryStore()
+
+    def stored_keys(self):
+        return sorted(self.store._data)
+
+
+class TestSQLiteStore(StoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = store.SQLiteStore(os.path.join(self.tmp_dir.name, "store.db"))
+
+    def tearDown(self):
+        while not self.store._pool.empty():
+            self.store._pool.get().close()
+        self.tmp_dir.cleanup()
+
+    def stored_keys(self):
+        with self.store.connection() as db:
+            return [row[0] for row in db.execute("SELECT key FROM store ORDER BY key")]
+
+    def test_wal(self):
+        with self.store.connection() as db:
+            self.assertEqual(db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+
+class TestCreate(unittest.TestCase):
+    def test_backends(self):
+        self.assertIsInstance(store.create("memory"), store.MemoryStore)
+        self.assertIsInstance(store.create("redis", host="redis.local", retries=0), store.RedisStore)
+        with self.assertRaises(ValueError):
+            store.create("memcached")
+
+
+if __name__ == "__main__":
+    unittest.main()